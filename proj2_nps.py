@@ -3,11 +3,48 @@
 ##### Uniqname: zhexinwu
 #################################
 
-from bs4 import BeautifulSoup
+# build_state_url_dict hands BeautifulSoup raw bytes so its encoding detection
+# can use cchardet (pip install cchardet / faust-cchardet) when available; the
+# lxml paths do no detection and take their charset from parse_html instead
+from bs4 import BeautifulSoup, SoupStrainer
+from bs4.dammit import EncodingDetector
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+import atexit
+import os
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import json
+try:
+    import orjson # optional, much faster cache load/save
+except ImportError:
+    orjson = None
+from lxml import html
+from lxml.etree import XPath
 import secrets # file that contains your API key
 
+# only build the parts of each page that the scrapers actually read
+STATE_MENU_STRAINER = SoupStrainer("ul", class_="dropdown-menu SearchBar-keywordSearch")
+
+
+def has_class(name):
+    """XPath predicate matching elements whose class list contains "name"."""
+    return f'contains(concat(" ", normalize-space(@class), " "), " {name} ")'
+
+
+# park links on a state page (CSS "ul li h3 a")
+XP_PARK_HREFS = XPath("//ul//li//h3//a/@href")
+
+# park page fields, compiled once; string() yields "" when the node is missing
+XP_NAME = XPath(f'string(//a[{has_class("Hero-title")}])')
+# category is a node list: a present-but-blank designation stays "" (see NationalSite)
+XP_CATEGORY = XPath(f'//span[{has_class("Hero-designation")}]')
+XP_ZIPCODE = XPath(f'string(//span[@itemprop="postalCode" and {has_class("postal-code")}])')
+XP_PHONE = XPath(f'string(//span[@itemprop="telephone" and {has_class("tel")}])')
+XP_CITY = XPath('string(//span[@itemprop="addressLocality"])')
+XP_STATE = XPath(f'string(//span[@itemprop="addressRegion" and {has_class("region")}])')
+
 
 class NationalSite:
     '''a national site
@@ -30,12 +67,16 @@ class NationalSite:
     phone: string
         the phone of a national site (e.g. '(616) 319-7906', '307-344-7381')
     '''
+    __slots__ = ("category", "name", "address", "zipcode", "phone", "_info")
+
     def __init__(self, category, name, address, zipcode, phone):
         self.category = category
         self.name = name
         self.address = address
         self.zipcode = zipcode
         self.phone = phone
+        # built once here since info() is called for every site in each listing
+        self._info = f"{name} ({category}): {address} {zipcode}"
 
     def info(self):
         """
@@ -50,9 +91,10 @@ class NationalSite:
         str
             <name> (<category>): <address> <zip>
         """
-        return f"{self.name} ({self.category}): {self.address} {self.zipcode}"
+        return self._info
 
 
+@lru_cache(maxsize=1)
 def build_state_url_dict():
     ''' Make a dictionary that maps state name to state page url from "https://www.nps.gov"
 
@@ -75,8 +117,8 @@ def build_state_url_dict():
         return CACHE_DICT[unique_key]
 
     print("Fetching")
-    resp = requests.get(base_url + main_url)
-    soup = BeautifulSoup(resp.text, "html.parser")
+    resp = SESSION.get(base_url + main_url)
+    soup = BeautifulSoup(resp.content, "lxml", parse_only=STATE_MENU_STRAINER)
     li_tags = soup.find("ul", class_="dropdown-menu SearchBar-keywordSearch").find_all("li")
     for li_tag in li_tags:
         anchor = li_tag.find("a")
@@ -84,11 +126,87 @@ def build_state_url_dict():
         out_dict[anchor.text.lower()] = ref
 
     CACHE_DICT[unique_key] = out_dict
-    save_cache(CACHE_DICT, CACHE_FILENAME)
+    mark_dirty()
 
     return out_dict
 
 
+def header_encoding(resp):
+    """
+    Return the charset declared in a response's Content-Type header.
+
+    Parameters
+    ----------
+    resp: requests.Response
+        A fetched page.
+
+    Returns
+    -------
+    str or None
+        The declared charset, or None if the header has none (requests
+        would otherwise report its ISO-8859-1 default for text/html).
+    """
+    if "charset" in resp.headers.get("Content-Type", "").lower():
+        return resp.encoding
+    return None
+
+
+def parse_html(content, encoding=None):
+    """
+    Parse raw HTML bytes with lxml using an explicit encoding. Without one,
+    lxml silently decodes pages lacking <meta charset> as Latin-1.
+
+    Parameters
+    ----------
+    content: bytes
+        Raw HTML, not empty.
+    encoding: str or None
+        Charset from the HTTP header; if None, the <meta> declaration is
+        used, then UTF-8.
+
+    Returns
+    -------
+    lxml.html.HtmlElement
+        The document root.
+    """
+    encoding = encoding or EncodingDetector.find_declared_encoding(content, is_html=True) or "utf-8"
+    return html.fromstring(content, parser=html.HTMLParser(encoding=encoding))
+
+
+def parse_site_page(content, encoding=None):
+    """
+    Extract the national site fields from a park page.
+
+    Parameters
+    ----------
+    content: bytes
+        Raw HTML of a national site page in nps.gov.
+    encoding: str or None
+        Charset from the HTTP header, see parse_html.
+
+    Returns
+    -------
+    dict
+        Keyword arguments for NationalSite, also used as the cache entry.
+    """
+    if not content.strip():
+        # lxml raises ParserError on an empty document; treat it as a page with no fields
+        return {"category": "No Category", "name": "No Name", "address": "No Address",
+                "zipcode": "No Zipcode", "phone": "No Phone"}
+
+    tree = parse_html(content, encoding)
+    name = XP_NAME(tree).strip() or "No Name"
+    cate_spans = XP_CATEGORY(tree)
+    cate = cate_spans[0].text_content().strip() if cate_spans else "No Category"
+    zip_code = XP_ZIPCODE(tree).strip() or "No Zipcode"
+    phone = XP_PHONE(tree).strip() or "No Phone"
+    city = XP_CITY(tree).strip()
+    state = XP_STATE(tree).strip()
+    address = f"{city}, {state}" if city and state else "No Address"
+
+    return {"category": cate, "name": name, "address": address, "zipcode": zip_code, "phone": phone}
+
+
 def get_site_instance(site_url):
     '''Make an instances from a national site URL.
     
@@ -108,36 +226,28 @@ def get_site_instance(site_url):
         return NationalSite(**json_dict)
 
     print("Fetching")
-    resp = requests.get(site_url)
-    soup = BeautifulSoup(resp.text, "html.parser")
-    # print(soup)
-    try:
-        name = soup.find("a", class_="Hero-title").text.strip()
-    except Exception:
-        name = "No Name"
-    try:
-        cate = soup.find("span", class_="Hero-designation").text.strip()
-    except Exception:
-        cate = "No Category"
-    try:
-        zip_code = soup.find("span", attrs={"itemprop": "postalCode", "class": "postal-code"}).text.strip()
-    except Exception:
-        zip_code = "No Zipcode"
-    try:
-        phone = soup.find("span", attrs={"itemprop": "telephone", "class": "tel"}).text.strip()
-    except Exception:
-        phone = "No Phone"
-    try:
-        city = soup.find("span", attrs={"itemprop": "addressLocality"}).text.strip()
-        state = soup.find("span", attrs={"itemprop": "addressRegion", "class": "region"}).text.strip()
-        address = f"{city}, {state}"
-    except Exception:
-        address = "No Address"
+    CACHE_DICT[site_url] = fetch_site_fields(site_url)
+    mark_dirty()
 
-    CACHE_DICT[site_url] = {"category": cate, "name": name, "address": address, "zipcode": zip_code, "phone": phone}
-    save_cache(CACHE_DICT, CACHE_FILENAME)
+    return NationalSite(**CACHE_DICT[site_url])
 
-    return NationalSite(cate, name, address, zip_code, phone)
+
+def fetch_site_fields(site_url):
+    """
+    Download a national site page and extract its fields.
+
+    Parameters
+    ----------
+    site_url: str
+        The URL for a national site page in nps.gov.
+
+    Returns
+    -------
+    dict
+        Keyword arguments for NationalSite, also used as the cache entry.
+    """
+    resp = SESSION.get(site_url)
+    return parse_site_page(resp.content, header_encoding(resp))
 
 
 def get_sites_for_state(state_url):
@@ -153,7 +263,6 @@ def get_sites_for_state(state_url):
     list
         a list of national site instances
     '''
-    sites = []
     if state_url in CACHE_DICT:
         print("Using cache")
         links = CACHE_DICT[state_url]
@@ -161,19 +270,76 @@ def get_sites_for_state(state_url):
     else:
         print("Fetching")
         base_url = "https://www.nps.gov"
-        resp = requests.get(state_url)
-        state_soup = BeautifulSoup(resp.text, "html.parser")
-        anchors = state_soup.select("ul li h3 a")
-        links = []
-        for anchor in anchors:
-            park_url = base_url + anchor["href"]
-            links.append(park_url)
+        resp = SESSION.get(state_url)
+        if not resp.content.strip():
+            links = []
+        else:
+            state_tree = parse_html(resp.content, header_encoding(resp))
+            links = [base_url + href for href in XP_PARK_HREFS(state_tree)]
         CACHE_DICT[state_url] = links
+        mark_dirty()
 
+    # fetch every park page that is not cached yet in one concurrent batch
+    missing = {} # ordered set: a park listed twice is fetched once
     for park_url in links:
-        sites.append(get_site_instance(park_url))
+        if park_url in CACHE_DICT or park_url in missing:
+            print("Using cache")
+        else:
+            print("Fetching")
+            missing[park_url] = None
+    if missing:
+        # flush in finally so pages fetched before a failure are not lost
+        try:
+            with ThreadPoolExecutor(max_workers=16) as executor:
+                for park_url, json_dict in zip(missing, executor.map(fetch_site_fields, missing)):
+                    CACHE_DICT[park_url] = json_dict
+                    mark_dirty()
+        finally:
+            flush_cache()
+
+    return [NationalSite(**CACHE_DICT[park_url]) for park_url in links]
+
+
+def get_nearby_params(site_object):
+    """
+    Build the MapQuest radius-search query for a national site.
 
-    return sites
+    Parameters
+    ----------
+    site_object: NationalSite
+        The site whose zipcode is used as the search origin.
+
+    Returns
+    -------
+    dict
+        Query parameters for MAPQUEST_ENDPOINT.
+    """
+    return {"key": secrets.API_KEY,
+            "origin": site_object.zipcode,
+            "radius": 10,
+            "maxMatches": 10,
+            "ambiguities": "ignore",
+            "outFormat": "json"}
+
+
+def fetch_nearby_places(params):
+    """
+    Query the MapQuest radius search without touching the cache.
+
+    Parameters
+    ----------
+    params: dict
+        Query parameters from get_nearby_params.
+
+    Returns
+    -------
+    dict
+        The decoded API response.
+    """
+    resp = SESSION.get(MAPQUEST_ENDPOINT, params=params)
+    if resp.status_code != 200:
+        raise Exception("Access Failed!")
+    return resp.json()
 
 
 def get_nearby_places(site_object):
@@ -189,14 +355,8 @@ def get_nearby_places(site_object):
     dict
         a converted API return from MapQuest API
     '''
-    endpoint = "http://www.mapquestapi.com/search/v2/radius"
-    params = {"key": secrets.API_KEY,
-              "origin": site_object.zipcode,
-              "radius": 10,
-              "maxMatches": 10,
-              "ambiguities": "ignore",
-              "outFormat": "json"}
-    unique_key = construct_unique_key(endpoint, params)
+    params = get_nearby_params(site_object)
+    unique_key = construct_unique_key(MAPQUEST_ENDPOINT, params)
     if unique_key in CACHE_DICT:
         print("Using cache")
         out_dict = CACHE_DICT[unique_key]
@@ -204,15 +364,51 @@ def get_nearby_places(site_object):
         return out_dict
     else:
         print("Fetching")
-        resp = requests.get(endpoint, params=params)
-        if resp.status_code != 200:
-            raise Exception("Access Failed!")
-        CACHE_DICT[unique_key] = resp.json()
-        save_cache(CACHE_DICT, CACHE_FILENAME)
+        CACHE_DICT[unique_key] = fetch_nearby_places(params)
+        mark_dirty()
         # print(CACHE_DICT[unique_key])
         return CACHE_DICT[unique_key]
 
 
+def get_nearby_places_batch(site_objects):
+    """
+    Obtain MapQuest results for several sites, querying the uncached ones
+    concurrently. At most 5 requests are in flight to respect MapQuest's
+    rate limits.
+
+    Parameters
+    ----------
+    site_objects: list
+        National site instances.
+
+    Returns
+    -------
+    list
+        The converted API returns, in the same order as "site_objects".
+    """
+    all_params = [get_nearby_params(site_object) for site_object in site_objects]
+    keys = [construct_unique_key(MAPQUEST_ENDPOINT, params) for params in all_params]
+    missing = {}
+    for unique_key, params in zip(keys, all_params):
+        if unique_key in CACHE_DICT or unique_key in missing:
+            print("Using cache")
+        else:
+            print("Fetching")
+            missing[unique_key] = params
+
+    if missing:
+        # flush in finally so results fetched before a failure are not lost
+        try:
+            with ThreadPoolExecutor(max_workers=5) as executor:
+                for unique_key, out_dict in zip(missing, executor.map(fetch_nearby_places, missing.values())):
+                    CACHE_DICT[unique_key] = out_dict
+                    mark_dirty()
+        finally:
+            flush_cache()
+
+    return [CACHE_DICT[unique_key] for unique_key in keys]
+
+
 def construct_unique_key(base_url, params, connector="_"):
     """
     Create a unique key for a query.
@@ -231,16 +427,13 @@ def construct_unique_key(base_url, params, connector="_"):
     str
         The unique key as a str.
     """
-    out_key = base_url
-    for key in params:
-        out_key += connector + f"{key}{connector}{params[key]}"
-
-    return out_key
+    return connector.join([base_url] + [f"{key}{connector}{params[key]}" for key in params])
 
 
 def open_cache(filename):
     """
-    Open or create a cache.json file.
+    Open a cache.json file. A missing or empty file gives an empty cache;
+    save_cache creates the file on the first flush.
 
     Parameters
     ----------
@@ -250,19 +443,22 @@ def open_cache(filename):
     Returns
     -------
     dict
-        Loaded or created cache as a dictionary.
+        Loaded cache as a dictionary.
     """
     try:
-        with open(filename, "r") as rf:
-            cache_dict = json.loads(rf.read())
-        # print("Using cache")
-        return cache_dict
+        with open(filename, "rb") as rf:
+            content = rf.read()
     except FileNotFoundError:
-        with open(filename, "w") as wf:
-            pass
         # print("Fetching")
         return {}
 
+    # an empty file is left behind by older versions that created it up front
+    if not content.strip():
+        return {}
+    cache_dict = orjson.loads(content) if orjson else json.loads(content)
+    # print("Using cache")
+    return cache_dict
+
 
 def save_cache(cache_dict, filename):
     """
@@ -279,8 +475,52 @@ def save_cache(cache_dict, filename):
     -------
     None
     """
-    with open(filename, "w") as wf:
-        wf.write(json.dumps(cache_dict))
+    # write a sibling file first so a crash never leaves a truncated cache
+    tmp_filename = filename + ".tmp"
+    if orjson:
+        with open(tmp_filename, "wb") as wf:
+            wf.write(orjson.dumps(cache_dict))
+    else:
+        with open(tmp_filename, "w") as wf:
+            json.dump(cache_dict, wf, separators=(",", ":"))
+    os.replace(tmp_filename, filename)
+
+
+def mark_dirty():
+    """
+    Record an update to CACHE_DICT. The cache file is rewritten every
+    CACHE_FLUSH_EVERY updates and once more at exit, instead of on every miss.
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    None
+    """
+    global CACHE_UNSAVED
+    CACHE_UNSAVED += 1
+    if CACHE_UNSAVED >= CACHE_FLUSH_EVERY:
+        flush_cache()
+
+
+def flush_cache():
+    """
+    Save CACHE_DICT to CACHE_FILENAME if it has unsaved updates.
+
+    Parameters
+    ----------
+    None
+
+    Returns
+    -------
+    None
+    """
+    global CACHE_UNSAVED
+    if CACHE_UNSAVED:
+        save_cache(CACHE_DICT, CACHE_FILENAME)
+        CACHE_UNSAVED = 0
 
 
 def process_part_4(result_dict):
@@ -297,29 +537,31 @@ def process_part_4(result_dict):
     None
     """
     json_dicts = result_dict["searchResults"]
-    # extracted_dicts = []
     for json_dict in json_dicts:
-        extracted_dict = dict()
-        extracted_dict["name"] = json_dict.get("name", "no name")
-        if "group_sic_code_name" in json_dict["fields"]:
-            extracted_dict["category"] = json_dict["fields"]["group_sic_code_name"]
-        elif "group_sic_code_name_ext" in json_dict["fields"]:
-            extracted_dict["category"] = json_dict["fields"]["group_sic_code_name_ext"]
-        else:
-            extracted_dict["category"] = "no category"
-        extracted_dict["address"] = json_dict.get("address", "no address")
-        extracted_dict["city"] = json_dict["fields"].get("city", "no city")
-
-        for key in extracted_dict:
-            if extracted_dict[key] == "":
-                extracted_dict[key] = f"no {key}"
+        fields = json_dict.get("fields", {})
+        name = json_dict.get("name") or "no name"
+        category = fields.get("group_sic_code_name") or fields.get("group_sic_code_name_ext") or "no category"
+        address = json_dict.get("address") or "no address"
+        city = fields.get("city") or "no city"
 
-        print(f"- {extracted_dict['name']} ({extracted_dict['category']}): {extracted_dict['address']}, " +
-              f"{extracted_dict['city']}")
+        print(f"- {name} ({category}): {address}, {city}")
 
 
+MAPQUEST_ENDPOINT = "http://www.mapquestapi.com/search/v2/radius"
 CACHE_FILENAME = "cache.json"
 CACHE_DICT = open_cache(CACHE_FILENAME)
+CACHE_UNSAVED = 0
+CACHE_FLUSH_EVERY = 50
+atexit.register(flush_cache)
+
+# one shared session so repeated requests to nps.gov / MapQuest reuse connections
+SESSION = requests.Session()
+SESSION.headers.update({"User-Agent": "SI507-Project2-nps-scraper"})
+# retry transient failures with backoff instead of aborting a half-scraped state
+RETRY = Retry(total=5, backoff_factor=0.3, status_forcelist=(429, 500, 502, 503, 504),
+              allowed_methods=frozenset(["GET"]))
+SESSION.mount("https://", HTTPAdapter(max_retries=RETRY, pool_connections=10, pool_maxsize=20))
+SESSION.mount("http://", HTTPAdapter(max_retries=RETRY, pool_connections=10, pool_maxsize=20))
 
 
 if __name__ == "__main__":
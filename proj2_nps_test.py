@@ -1,4 +1,7 @@
+import os
+import tempfile
 import unittest
+from unittest import mock
 import proj2_nps as nps
 
 # SI 507 Fall 2020
@@ -84,5 +87,220 @@ class Test_Part4(unittest.TestCase):
         self.assertEqual(self.near_wy['options']['radius'], 10)
 
 
+class Test_ParseSitePage(unittest.TestCase):
+    # offline checks of the park page extractor, no network or API key needed
+    PAGE = b"""
+    <html><body>
+      <div class="Hero-titleContainer">
+        <a href="/yell/" class="Hero-title ">Yellowstone</a>
+        <span class="Hero-designation">National Park</span>
+      </div>
+      <p class="adr">
+        <span itemprop="addressLocality">Yellowstone National Park</span>,
+        <span itemprop="addressRegion" class="region">WY</span>
+        <span itemprop="postalCode" class="postal-code">82190-0168 </span>
+      </p>
+      <span itemprop="telephone" class="tel">
+        307-344-7381
+      </span>
+    </body></html>
+    """
+
+    def test_5_1_fields(self):
+        fields = nps.parse_site_page(self.PAGE)
+        self.assertEqual(fields, {"category": "National Park", "name": "Yellowstone",
+                                  "address": "Yellowstone National Park, WY",
+                                  "zipcode": "82190-0168", "phone": "307-344-7381"})
+
+    def test_5_2_missing_fields(self):
+        fields = nps.parse_site_page(b"<html><body><p>Nothing here</p></body></html>")
+        self.assertEqual(fields, {"category": "No Category", "name": "No Name",
+                                  "address": "No Address", "zipcode": "No Zipcode",
+                                  "phone": "No Phone"})
+
+    def test_5_3_partial_address(self):
+        page = b'<html><body><span itemprop="addressLocality">Lowell</span></body></html>'
+        self.assertEqual(nps.parse_site_page(page)["address"], "No Address")
+
+    def test_5_4_blank_category(self):
+        page = b'<html><body><a class="Hero-title">X</a><span class="Hero-designation"> </span></body></html>'
+        self.assertEqual(nps.parse_site_page(page)["category"], "")
+
+    def test_5_6_non_ascii_without_meta_charset(self):
+        page = '<html><body><a class="Hero-title">Haleakalā</a></body></html>'.encode("utf-8")
+        self.assertEqual(nps.parse_site_page(page)["name"], "Haleakalā")
+        self.assertEqual(nps.parse_site_page(page, "utf-8")["name"], "Haleakalā")
+
+    def test_5_7_declared_charsets(self):
+        page = '<html><head><meta charset="windows-1252"></head><body><a class="Hero-title">Café</a></body></html>'
+        self.assertEqual(nps.parse_site_page(page.encode("cp1252"))["name"], "Café")
+        page = '<html><body><a class="Hero-title">Café</a></body></html>'
+        self.assertEqual(nps.parse_site_page(page.encode("cp1252"), "windows-1252")["name"], "Café")
+
+    def test_5_8_header_encoding(self):
+        resp = nps.requests.Response()
+        resp.headers["Content-Type"] = "text/html"
+        self.assertIsNone(nps.header_encoding(resp))
+        resp = nps.requests.Response()
+        resp.headers["Content-Type"] = "text/html; charset=UTF-8"
+        resp.encoding = nps.requests.utils.get_encoding_from_headers(resp.headers)
+        self.assertEqual(nps.header_encoding(resp), "UTF-8")
+
+    def test_5_5_empty_page(self):
+        self.assertEqual(nps.parse_site_page(b"")["name"], "No Name")
+        self.assertEqual(nps.parse_site_page(b" \n ")["phone"], "No Phone")
+
+
+class Test_CacheFile(unittest.TestCase):
+    # offline: open_cache / save_cache / mark_dirty against a temporary directory
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.filename = os.path.join(tmp_dir.name, "cache.json")
+        for patcher in [mock.patch.object(nps, "CACHE_DICT", {}),
+                        mock.patch.object(nps, "CACHE_FILENAME", self.filename),
+                        mock.patch.object(nps, "CACHE_UNSAVED", 0),
+                        mock.patch.object(nps, "CACHE_FLUSH_EVERY", 3)]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_8_1_missing_file(self):
+        self.assertEqual(nps.open_cache(self.filename), {})
+        self.assertFalse(os.path.exists(self.filename))
+
+    def test_8_2_empty_file(self):
+        with open(self.filename, "w") as wf:
+            wf.write("\n")
+        self.assertEqual(nps.open_cache(self.filename), {})
+
+    def test_8_3_round_trip(self):
+        cache_dict = {"https://www.nps.gov/hale/index.htm": {"name": "Haleakalā"}, "links": ["a", "b"]}
+        nps.save_cache(cache_dict, self.filename)
+        self.assertEqual(nps.open_cache(self.filename), cache_dict)
+        self.assertFalse(os.path.exists(self.filename + ".tmp"))
+
+    def test_8_4_flush_every(self):
+        nps.CACHE_DICT["a"] = 1
+        nps.mark_dirty()
+        nps.mark_dirty()
+        self.assertFalse(os.path.exists(self.filename))
+        nps.mark_dirty()
+        self.assertEqual(nps.open_cache(self.filename), {"a": 1})
+        self.assertEqual(nps.CACHE_UNSAVED, 0)
+
+    def test_8_5_flush_cache_only_when_dirty(self):
+        nps.flush_cache()
+        self.assertFalse(os.path.exists(self.filename))
+        nps.CACHE_DICT["a"] = 1
+        nps.mark_dirty()
+        nps.flush_cache()
+        self.assertEqual(nps.open_cache(self.filename), {"a": 1})
+
+    def test_8_6_failed_write_keeps_old_file(self):
+        nps.save_cache({"a": 1}, self.filename)
+        with self.assertRaises(TypeError):
+            nps.save_cache({"a": object()}, self.filename)
+        self.assertEqual(nps.open_cache(self.filename), {"a": 1})
+
+
+class Test_NearbyPlacesBatch(unittest.TestCase):
+    # offline: MapQuest, the API key and the cache file are all stubbed
+    def setUp(self):
+        self.fetched = []
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        for patcher in [mock.patch.object(nps, "CACHE_DICT", {}),
+                        mock.patch.object(nps, "CACHE_FILENAME", os.path.join(tmp_dir.name, "cache.json")),
+                        mock.patch.object(nps.secrets, "API_KEY", "test-key", create=True),
+                        mock.patch.object(nps, "fetch_nearby_places", self.fake_fetch)]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.sites = [nps.NationalSite("National Park", name, "City, ST", zipcode, "No Phone")
+                      for name, zipcode in [("A", "49931"), ("B", "82190"), ("C", "49931"), ("D", "49331")]]
+        cached_key = nps.construct_unique_key(nps.MAPQUEST_ENDPOINT, nps.get_nearby_params(self.sites[3]))
+        nps.CACHE_DICT[cached_key] = {"origin": "cached"}
+
+    def fake_fetch(self, params):
+        self.fetched.append(params["origin"])
+        return {"origin": params["origin"]}
+
+    def test_6_1_order(self):
+        results = nps.get_nearby_places_batch(self.sites)
+        self.assertEqual([result["origin"] for result in results], ["49931", "82190", "49931", "cached"])
+
+    def test_6_2_fetches_each_missing_key_once(self):
+        nps.get_nearby_places_batch(self.sites)
+        self.assertEqual(sorted(self.fetched), ["49931", "82190"])
+        self.assertTrue(os.path.exists(nps.CACHE_FILENAME))
+
+    def test_6_3_partial_failure_is_saved(self):
+        def flaky_fetch(params):
+            if params["origin"] == "82190":
+                raise ConnectionError("transient")
+            return {"origin": params["origin"]}
+
+        with mock.patch.object(nps, "fetch_nearby_places", flaky_fetch):
+            with self.assertRaises(ConnectionError):
+                nps.get_nearby_places_batch(self.sites)
+        saved = nps.open_cache(nps.CACHE_FILENAME)
+        self.assertIn({"origin": "49931"}, saved.values())
+
+
+class FakeSession:
+    # stands in for nps.SESSION; serves canned pages and records requested URLs
+    def __init__(self, pages):
+        self.pages = pages
+        self.requested = []
+
+    def get(self, url):
+        self.requested.append(url)
+        resp = nps.requests.Response()
+        resp._content = self.pages[url]
+        resp.headers["Content-Type"] = "text/html"
+        return resp
+
+
+class Test_SitesForState(unittest.TestCase):
+    # offline: nps.gov and the cache file are stubbed
+    STATE_URL = "https://www.nps.gov/state/hi/index.htm"
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        for patcher in [mock.patch.object(nps, "CACHE_DICT", {}),
+                        mock.patch.object(nps, "CACHE_FILENAME", os.path.join(tmp_dir.name, "cache.json"))]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def use_pages(self, pages):
+        session = FakeSession(pages)
+        patcher = mock.patch.object(nps, "SESSION", session)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return session
+
+    def test_7_1_empty_state_page(self):
+        self.use_pages({self.STATE_URL: b""})
+        self.assertEqual(nps.get_sites_for_state(self.STATE_URL), [])
+
+    def test_7_2_non_ascii_state_page(self):
+        state_page = '<html><body><ul><li><h3><a href="/hale/index.htm">Haleakalā</a></h3></li></ul></body></html>'
+        park_page = '<html><body><a class="Hero-title">Haleakalā</a></body></html>'
+        self.use_pages({self.STATE_URL: state_page.encode("utf-8"),
+                        "https://www.nps.gov/hale/index.htm": park_page.encode("utf-8")})
+        sites = nps.get_sites_for_state(self.STATE_URL)
+        self.assertEqual([site.name for site in sites], ["Haleakalā"])
+
+    def test_7_3_duplicate_links_fetched_once(self):
+        state_page = (b'<html><body><ul><li><h3><a href="/hale/index.htm">A</a></h3></li>'
+                      b'<li><h3><a href="/hale/index.htm">A</a></h3></li></ul></body></html>')
+        session = self.use_pages({self.STATE_URL: state_page,
+                                  "https://www.nps.gov/hale/index.htm": b'<a class="Hero-title">A</a>'})
+        sites = nps.get_sites_for_state(self.STATE_URL)
+        self.assertEqual([site.name for site in sites], ["A", "A"])
+        self.assertEqual(session.requested.count("https://www.nps.gov/hale/index.htm"), 1)
+
+
 if __name__ == '__main__':
     unittest.main()